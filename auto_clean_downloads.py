@@ -5,15 +5,23 @@ Auto-Clean Downloads - Organize and clean your Downloads folder automatically.
 
 import os
 import sys
+import errno
 import json
+import mmap
 import shutil
 import hashlib
 import argparse
 from pathlib import Path
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Set, Tuple, Optional
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 # File categories mapping
 CATEGORIES = {
     'Images': {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg', '.webp', '.ico', '.tiff', '.heic'},
@@ -26,9 +34,49 @@ CATEGORIES = {
     'Code': {'.py', '.js', '.java', '.cpp', '.c', '.h', '.cs', '.php', '.rb', '.go', '.rs', '.swift', '.kt', '.ts', '.jsx', '.tsx', '.html', '.css', '.scss', '.json', '.xml', '.yaml', '.yml', '.sh', '.bat', '.ps1'},
 }
 
+# Reverse lookup of CATEGORIES; built in reverse so that an extension listed
+# under several categories (e.g. .dmg) maps to the first one, as before
+EXT_TO_CATEGORY: Dict[str, str] = {
+    ext: category
+    for category, extensions in reversed(list(CATEGORIES.items()))
+    for ext in extensions
+}
+
 TEMP_EXTENSIONS = {'.crdownload', '.part', '.tmp', '.partial', '.download', '.temp'}
 
-HISTORY_FILE = '.cleanup_history.json'
+# Temp files share the lookup table under a sentinel tag, so one dict lookup
+# per file decides between removal and categorization
+TEMP_TAG = '__TEMP__'
+EXT_TO_CATEGORY.update({ext: TEMP_TAG for ext in TEMP_EXTENSIONS})
+
+# One JSON session record per line, so runs append rather than rewrite
+HISTORY_FILE = '.cleanup_history.jsonl'
+
+# Whole-file JSON history written by earlier versions; still honoured by undo
+LEGACY_HISTORY_FILE = '.cleanup_history.json'
+
+# Sparse hashing: files at least this large are pre-screened by sampling
+# the head, middle and tail before a full hash is computed
+SPARSE_HASH_MIN_SIZE = 48 * 1024
+SPARSE_SAMPLE_SIZE = 4096
+
+# Files smaller than this are compared on their raw content instead of a hash
+SMALL_FILE_SIZE = 64
+
+# Read buffer for full-file hashing
+HASH_CHUNK_SIZE = 128 * 1024
+
+# Files larger than this are hashed through a read-only memory map
+MMAP_MIN_SIZE = 16 * 1024 * 1024
+
+# Page-cache hints for hashing reads are only available on some platforms
+HAS_FADVISE = hasattr(os, 'posix_fadvise')
+
+# hashlib.file_digest (Python 3.11+) reads into a reused buffer with readinto()
+HAS_FILE_DIGEST = hasattr(hashlib, 'file_digest')
+
+# A regular file found in the source folder, as captured by a single scan
+Entry = namedtuple('Entry', 'path name ext category size')
 
 
 class DownloadsCleaner:
@@ -52,54 +100,215 @@ class DownloadsCleaner:
         }
         
         self.history: List[Dict] = []
-        self.file_hashes: Dict[str, List[Path]] = defaultdict(list)
+        self._session_start = datetime.now().isoformat()
+        self.file_hashes: Dict[str, List[str]] = defaultdict(list)
+        self.moved_duplicates: Set[str] = set()
+        self._created_dirs: Set[Path] = set()
+        self._conflict_counters: Dict[Tuple[str, str, str], int] = {}
     
     def log(self, message: str, force: bool = False):
         """Print message if verbose mode is enabled or force is True."""
         if self.verbose or force:
             print(message)
     
-    def calculate_hash(self, file_path: Path) -> str:
-        """Calculate SHA-256 hash of a file."""
+    def _scan(self) -> Tuple[List[Entry], List[Entry]]:
+        """Scan the source folder once, splitting files into (temp, others)."""
+        temp_files: List[Entry] = []
+        other_files: List[Entry] = []
+        with os.scandir(self.source_path) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if entry.name in (HISTORY_FILE, LEGACY_HISTORY_FILE):
+                    continue
+                ext = os.path.splitext(entry.name)[1].lower()
+                category = EXT_TO_CATEGORY.get(ext, 'Others')
+                size = entry.stat(follow_symlinks=False).st_size
+                files = temp_files if category == TEMP_TAG else other_files
+                files.append(Entry(entry.path, entry.name, ext, category, size))
+        return temp_files, other_files
+    
+    def _update_hash(self, file_hash, f):
+        """Feed the whole of an open binary file into file_hash."""
+        if os.fstat(f.fileno()).st_size > MMAP_MIN_SIZE:
+            try:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    file_hash.update(mm)
+                return
+            except (OSError, ValueError):
+                # Some filesystems (e.g. network mounts) cannot be mapped
+                pass
+        if HAS_FILE_DIGEST:
+            hashlib.file_digest(f, lambda: file_hash)
+            return
+        for byte_block in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(byte_block)
+    
+    def _fadvise(self, fd: int, advice: str):
+        """Give the kernel a page-cache hint, ignoring platforms or files that refuse it."""
+        if not HAS_FADVISE:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            # Only a hint (e.g. EINVAL/ESPIPE on special filesystems); never
+            # let it change the hash result
+            pass
+    
+    def calculate_hash(self, file_path: str) -> str:
+        """Calculate BLAKE3 hash of a file, falling back to SHA-256."""
+        file_hash = blake3.blake3() if blake3 else hashlib.sha256()
+        try:
+            with open(file_path, "rb", buffering=0) as f:
+                fd = f.fileno()
+                self._fadvise(fd, 'POSIX_FADV_SEQUENTIAL')
+                try:
+                    self._update_hash(file_hash, f)
+                finally:
+                    # The content is not needed again; keep it out of the page cache
+                    self._fadvise(fd, 'POSIX_FADV_DONTNEED')
+            return file_hash.hexdigest()
+        except Exception as e:
+            self.log(f"Error hashing {file_path}: {e}")
+            return ""
+    
+    def _sparse_hash(self, file_path: str, size: int) -> str:
+        """Hash 4 KB samples from the start, middle and end of a file."""
         sha256_hash = hashlib.sha256()
         try:
             with open(file_path, "rb") as f:
-                for byte_block in iter(lambda: f.read(4096), b""):
-                    sha256_hash.update(byte_block)
+                for offset in (0, size // 2, size - SPARSE_SAMPLE_SIZE):
+                    f.seek(offset)
+                    sha256_hash.update(f.read(SPARSE_SAMPLE_SIZE))
             return sha256_hash.hexdigest()
         except Exception as e:
             self.log(f"Error hashing {file_path}: {e}")
             return ""
     
+    def _small_file_key(self, file_path: str) -> str:
+        """Use the content of a small file directly as its duplicate key."""
+        try:
+            with open(file_path, "rb") as f:
+                return "raw:" + f.read(SMALL_FILE_SIZE).hex()
+        except Exception as e:
+            self.log(f"Error reading {file_path}: {e}")
+            return ""
+    
     def get_category(self, file_path: Path) -> str:
         """Determine the category of a file based on its extension."""
-        ext = file_path.suffix.lower()
-        for category, extensions in CATEGORIES.items():
-            if ext in extensions:
-                return category
-        return 'Others'
-    
-    def move_file(self, source: Path, destination: Path) -> bool:
-        """Move a file from source to destination, handling conflicts."""
+        category = EXT_TO_CATEGORY.get(file_path.suffix.lower(), 'Others')
+        return 'Others' if category == TEMP_TAG else category
+    
+    def _list_names(self, folder: Path) -> Optional[Set[str]]:
+        """Return the set of entry names in a folder (empty if it does not exist).
+        
+        Returns None if the folder cannot be listed (e.g. it is a regular file
+        or unreadable), so callers fall back to per-file exists() checks.
+        """
+        try:
+            return set(os.listdir(folder))
+        except FileNotFoundError:
+            return set()
+        except OSError as e:
+            self.log(f"Cannot list {folder}: {e}")
+            return None
+    
+    def _free_name(self, destination: Path, is_taken) -> Path:
+        """Return destination, or the first free _N variant of it."""
+        if not is_taken(destination):
+            return destination
+        
+        # Handle name conflict
+        base = destination.stem
+        ext = destination.suffix
+        # Resume from the last suffix used for this name so repeated
+        # conflicts do not re-probe every earlier _N
+        key = (destination.parent.name, base, ext)
+        counter = self._conflict_counters.get(key, 0)
+        while is_taken(destination):
+            counter += 1
+            destination = destination.parent / f"{base}_{counter}{ext}"
+        self._conflict_counters[key] = counter
+        return destination
+    
+    def _ensure_dir(self, folder: Path):
+        """Create a target folder, at most once per run."""
+        if folder not in self._created_dirs:
+            folder.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(folder)
+    
+    def _precreate_dir(self, folder: Path):
+        """Create a target folder ahead of its moves.
+        
+        A failure is only logged here; each move into the folder then retries
+        the mkdir and reports its own error, as it did before pre-creation.
+        """
         try:
-            if destination.exists():
-                # Handle name conflict
-                base = destination.stem
-                ext = destination.suffix
-                counter = 1
-                while destination.exists():
-                    destination = destination.parent / f"{base}_{counter}{ext}"
-                    counter += 1
+            self._ensure_dir(folder)
+        except OSError as e:
+            self.log(f"Error creating {folder}: {e}", force=True)
+    
+    def _move_no_clobber(self, source: Path, destination: Path):
+        """Move source to destination without ever replacing an existing file."""
+        try:
+            # link() fails if destination exists, even under another case on
+            # case-insensitive volumes, where rename() would overwrite it
+            os.link(source, destination)
+        except FileExistsError:
+            raise
+        except OSError:
+            # No hard links here (other device, FAT, some network shares);
+            # check for a clash right before a plain move instead
+            if os.path.lexists(destination):
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(destination))
+            try:
+                os.rename(source, destination)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                shutil.move(str(source), str(destination))
+        else:
+            try:
+                os.unlink(source)
+            except OSError:
+                os.unlink(destination)
+                raise
+    
+    def move_file(self, source: Path, destination: Path,
+                  existing_names: Optional[Set[str]] = None) -> bool:
+        """Move a file from source to destination, handling conflicts.
+        
+        If existing_names is given it must hold the names already present in
+        destination.parent; conflicts are then resolved against it instead of
+        the filesystem, and the chosen name is added to it.
+        """
+        try:
+            original = destination
+            if existing_names is not None:
+                destination = self._free_name(original, lambda path: path.name in existing_names)
+            else:
+                destination = self._free_name(original, lambda path: path.exists())
             
             if not self.dry_run:
-                destination.parent.mkdir(parents=True, exist_ok=True)
-                shutil.move(str(source), str(destination))
+                self._ensure_dir(destination.parent)
+                try:
+                    self._move_no_clobber(source, destination)
+                except FileExistsError:
+                    if existing_names is None:
+                        raise
+                    # The listing is case-sensitive but the filesystem may not
+                    # be (macOS, Windows); re-pick against the disk and retry once
+                    destination = self._free_name(
+                        original, lambda path: path.name in existing_names or path.exists())
+                    self._move_no_clobber(source, destination)
+            
+            if existing_names is not None:
+                existing_names.add(destination.name)
             
             self.history.append({
                 'action': 'move',
                 'source': str(source),
-                'destination': str(destination),
-                'timestamp': datetime.now().isoformat()
+                'destination': str(destination)
             })
             
             return True
@@ -108,16 +317,15 @@ class DownloadsCleaner:
             self.stats['errors'] += 1
             return False
     
-    def remove_file(self, file_path: Path) -> bool:
+    def remove_file(self, file_path: str) -> bool:
         """Remove a file."""
         try:
             if not self.dry_run:
-                file_path.unlink()
+                os.unlink(file_path)
             
             self.history.append({
                 'action': 'delete',
-                'source': str(file_path),
-                'timestamp': datetime.now().isoformat()
+                'source': file_path
             })
             
             return True
@@ -126,62 +334,111 @@ class DownloadsCleaner:
             self.stats['errors'] += 1
             return False
 
-    def clean_temp_files(self):
+    def clean_temp_files(self, temp_files: List[Entry]):
         """Remove temporary and partial download files."""
         if self.no_temp_clean:
             return
         
         self.log("\n=== Cleaning Temporary Files ===")
-        for file_path in self.source_path.iterdir():
-            if file_path.is_file() and file_path.suffix.lower() in TEMP_EXTENSIONS:
-                self.log(f"Removing temp file: {file_path.name}")
-                if self.remove_file(file_path):
-                    self.stats['temp_removed'] += 1
-    
-    def find_duplicates(self):
-        """Find duplicate files by comparing SHA-256 hashes."""
+        for entry in temp_files:
+            self.log(f"Removing temp file: {entry.name}")
+            if self.remove_file(entry.path):
+                self.stats['temp_removed'] += 1
+    
+    def find_duplicates(self, files: List[Entry]):
+        """Find duplicate files by comparing content hashes."""
         if self.no_duplicates:
             return
         
         self.log("\n=== Scanning for Duplicates ===")
-        files = [f for f in self.source_path.iterdir() if f.is_file()]
+        # Group by size first; a file with a unique size cannot have a duplicate
+        sizes: Dict[int, List[Entry]] = defaultdict(list)
+        for entry in files:
+            sizes[entry.size].append(entry)
         
-        for file_path in files:
-            if file_path.suffix.lower() in TEMP_EXTENSIONS:
+        candidates: List[Entry] = []
+        for size, same_size in sizes.items():
+            if len(same_size) < 2:
                 continue
             
-            file_hash = self.calculate_hash(file_path)
-            if file_hash:
-                self.file_hashes[file_hash].append(file_path)
+            # Empty files are all identical, and tiny ones are cheaper to
+            # compare by content than to hash
+            if size == 0:
+                self.file_hashes['__empty__'].extend(e.path for e in same_size)
+                continue
+            if size < SMALL_FILE_SIZE:
+                for entry in same_size:
+                    key = self._small_file_key(entry.path)
+                    if key:
+                        self.file_hashes[key].append(entry.path)
+                continue
+            
+            # Large files of equal size are compared on samples before a full read
+            if size >= SPARSE_HASH_MIN_SIZE:
+                sparse_hashes: Dict[str, List[Entry]] = defaultdict(list)
+                for entry in same_size:
+                    sparse_hash = self._sparse_hash(entry.path, size)
+                    if sparse_hash:
+                        sparse_hashes[sparse_hash].append(entry)
+                groups = [g for g in sparse_hashes.values() if len(g) > 1]
+            else:
+                groups = [same_size]
+            
+            for group in groups:
+                candidates.extend(group)
+        
+        # Hashing is I/O-bound, so overlap reads across a thread pool
+        paths = [e.path for e in candidates]
+        with ThreadPoolExecutor() as executor:
+            for file_path, file_hash in zip(paths, executor.map(self.calculate_hash, paths)):
+                if file_hash:
+                    self.file_hashes[file_hash].append(file_path)
         
         # Process duplicates
+        duplicates_folder = self.target_path / 'Duplicates'
+        duplicate_names: Optional[Set[str]] = None
+        if any(len(v) > 1 for v in self.file_hashes.values()):
+            duplicate_names = self._list_names(duplicates_folder)
+            if not self.dry_run:
+                self._precreate_dir(duplicates_folder)
         for file_hash, file_list in self.file_hashes.items():
             if len(file_list) > 1:
                 # Keep the first file, move others to Duplicates
                 self.log(f"Found {len(file_list)} duplicates:")
                 for i, file_path in enumerate(file_list):
-                    self.log(f"  [{i+1}] {file_path.name}")
+                    self.log(f"  [{i+1}] {os.path.basename(file_path)}")
                 
                 for duplicate in file_list[1:]:
-                    dest = self.target_path / 'Duplicates' / duplicate.name
-                    self.log(f"Moving duplicate: {duplicate.name}")
-                    if self.move_file(duplicate, dest):
+                    name = os.path.basename(duplicate)
+                    dest = duplicates_folder / name
+                    self.log(f"Moving duplicate: {name}")
+                    if self.move_file(Path(duplicate), dest, duplicate_names):
+                        self.moved_duplicates.add(duplicate)
                         self.stats['duplicates_found'] += 1
     
-    def categorize_files(self):
+    def categorize_files(self, files: List[Entry]):
         """Categorize and move files to appropriate folders."""
         self.log("\n=== Categorizing Files ===")
-        files = [f for f in self.source_path.iterdir() if f.is_file()]
+        # List and create only the category folders this run will fill
+        needed = {e.category for e in files if e.path not in self.moved_duplicates}
+        existing_names: Dict[str, Optional[Set[str]]] = {
+            category: self._list_names(self.target_path / category)
+            for category in needed
+        }
+        
+        # Create each needed category folder up front rather than per move
+        if not self.dry_run:
+            for category in needed:
+                self._precreate_dir(self.target_path / category)
         
-        for file_path in files:
-            if file_path.suffix.lower() in TEMP_EXTENSIONS:
+        for entry in files:
+            if entry.path in self.moved_duplicates:
                 continue
             
-            category = self.get_category(file_path)
-            dest = self.target_path / category / file_path.name
+            dest = self.target_path / entry.category / entry.name
             
-            self.log(f"Categorizing {file_path.name} -> {category}")
-            if self.move_file(file_path, dest):
+            self.log(f"Categorizing {entry.name} -> {entry.category}")
+            if self.move_file(Path(entry.path), dest, existing_names[entry.category]):
                 self.stats['categorized'] += 1
     
     def merge_pdf_files(self):
@@ -190,7 +447,7 @@ class DownloadsCleaner:
             return
         
         try:
-            from pypdf import PdfMerger
+            from pypdf import PdfReader, PdfWriter
         except ImportError:
             print("\n⚠️  pypdf not installed. To enable PDF merging, run:")
             print("    pip install pypdf")
@@ -208,20 +465,36 @@ class DownloadsCleaner:
         self.log(f"\n=== Merging {len(pdf_files)} PDF files ===")
         
         try:
-            merger = PdfMerger()
-            for pdf in pdf_files:
-                self.log(f"Adding: {pdf.name}")
-                if not self.dry_run:
-                    merger.append(str(pdf))
-            
             output_name = f"merged_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
             output_path = pdf_folder / output_name
             
-            if not self.dry_run:
-                merger.write(str(output_path))
-                merger.close()
+            writer = PdfWriter()
+            try:
+                for pdf in pdf_files:
+                    self.log(f"Adding: {pdf.name}")
+                    if not self.dry_run:
+                        # Lenient parsing skips strict cross-reference validation
+                        writer.append(PdfReader(str(pdf), strict=False))
                 
-                # Remove original PDFs after successful merge
+                if not self.dry_run:
+                    # Write to a temp file and move it into place, so a failed
+                    # write never leaves a truncated merged_*.pdf behind
+                    tmp_path = output_path.with_suffix('.pdf.tmp')
+                    try:
+                        with open(tmp_path, 'wb') as out:
+                            writer.write(out)
+                            out.flush()
+                            os.fsync(out.fileno())
+                        os.replace(tmp_path, output_path)
+                    except Exception:
+                        if tmp_path.exists():
+                            tmp_path.unlink()
+                        raise
+            finally:
+                writer.close()
+            
+            if not self.dry_run:
+                # Remove original PDFs only once the merged file is in place
                 for pdf in pdf_files:
                     pdf.unlink()
             
@@ -240,26 +513,24 @@ class DownloadsCleaner:
             self.stats['errors'] += 1
     
     def save_history(self):
-        """Save cleanup history to JSON file."""
+        """Append this session to the JSON Lines history file."""
         if self.dry_run or not self.history:
             return
         
         history_path = self.source_path / HISTORY_FILE
         
         try:
-            existing_history = []
-            if history_path.exists():
-                with open(history_path, 'r') as f:
-                    existing_history = json.load(f)
-            
-            existing_history.append({
-                'session': datetime.now().isoformat(),
+            session = {
+                'session': self._session_start,
                 'operations': self.history,
                 'stats': self.stats
-            })
+            }
             
-            with open(history_path, 'w') as f:
-                json.dump(existing_history, f, indent=2)
+            # Stream the encoded record instead of building one large string
+            encoder = json.JSONEncoder(separators=(',', ':'))
+            with open(history_path, 'a') as f:
+                f.writelines(encoder.iterencode(session))
+                f.write('\n')
             
             self.log(f"\n✓ History saved to {history_path}")
         
@@ -297,31 +568,71 @@ class DownloadsCleaner:
             print("Mode: DRY RUN (no changes will be made)")
         print()
         
-        self.clean_temp_files()
-        self.find_duplicates()
-        self.categorize_files()
-        self.merge_pdf_files()
-        self.save_history()
+        temp_files, other_files = self._scan()
+        try:
+            self.clean_temp_files(temp_files)
+            self.find_duplicates(other_files)
+            self.categorize_files(other_files)
+            self.merge_pdf_files()
+        finally:
+            # Record whatever was done, even if a phase failed, so it can be undone
+            self.save_history()
         self.print_summary()
 
 
+def _read_last_session(history_path: Path) -> Tuple[Optional[Dict], int]:
+    """Return the last session in a history file and the offset it starts at.
+    
+    The file is read backwards from the end, so only the last line is loaded.
+    Returns (None, 0) if the file holds no sessions.
+    """
+    with open(history_path, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        tail = b''
+        while pos > 0:
+            step = min(4096, pos)
+            pos -= step
+            f.seek(pos)
+            tail = f.read(step) + tail
+            newline = tail.rstrip(b'\n').rfind(b'\n')
+            if newline != -1:
+                pos += newline + 1
+                tail = tail[newline + 1:]
+                break
+    
+    if not tail.strip():
+        return None, 0
+    return json.loads(tail), pos
+
+
 def undo_cleanup(source_path: Path, dry_run: bool = False, verbose: bool = False):
     """Attempt to undo the last cleanup operation."""
     history_path = source_path / HISTORY_FILE
+    legacy_path = source_path / LEGACY_HISTORY_FILE
     
-    if not history_path.exists():
+    if not history_path.exists() and not legacy_path.exists():
         print("❌ No cleanup history found. Cannot undo.")
         sys.exit(1)
     
     try:
-        with open(history_path, 'r') as f:
-            history = json.load(f)
+        last_session, offset = None, 0
+        if history_path.exists():
+            last_session, offset = _read_last_session(history_path)
+        
+        # Fall back to the history file of earlier versions once the
+        # JSON Lines history has nothing left to undo
+        legacy_history = None
+        if last_session is None and legacy_path.exists():
+            print(f"ℹ️  Using legacy history file: {legacy_path}")
+            with open(legacy_path, 'r') as f:
+                legacy_history = json.load(f)
+            if legacy_history:
+                last_session = legacy_history[-1]
         
-        if not history:
+        if last_session is None:
             print("❌ No cleanup sessions found in history.")
             sys.exit(1)
         
-        last_session = history[-1]
         operations = last_session['operations']
         
         print(f"\n🔄 Undoing cleanup from: {last_session['session']}")
@@ -374,9 +685,13 @@ def undo_cleanup(source_path: Path, dry_run: bool = False, verbose: bool = False
         
         if not dry_run:
             # Remove the last session from history
-            history.pop()
-            with open(history_path, 'w') as f:
-                json.dump(history, f, indent=2)
+            if legacy_history is not None:
+                legacy_history.pop()
+                with open(legacy_path, 'w') as f:
+                    json.dump(legacy_history, f, indent=2)
+            else:
+                with open(history_path, 'r+b') as f:
+                    f.truncate(offset)
             print("\n✓ History updated.")
         else:
             print("\n💡 This was a dry run. No files were actually moved.")